@@ -6,7 +6,8 @@ from dotenv import load_dotenv
 from yaml import safe_load
 
 import gradio as gr
-from chatbot_engine import chat, create_index_list
+from chatbot_engine import chat, create_agent_executor, create_index_list
+from llm import create_llm
 
 from langchain.memory import ChatMessageHistory
 
@@ -22,29 +23,34 @@ class App:
     def __init__(self, config):
         self.config = config
         self.indexes = create_index_list(config)
+        self.llm = create_llm()
+        self.agent_executor = create_agent_executor(self.indexes, self.llm)
         logger.info('App initialized with config: %s', config)
 
-    def _respond(self, message, chat_history):
-        history = ChatMessageHistory()
-        for [user_message, ai_message] in chat_history:
-            history.add_user_message(user_message)
-            history.add_ai_message(ai_message)
+    async def _respond(self, message, chat_history, history):
+        # history mirrors the visible transcript for the agent. It lives in
+        # per-session state and only grows by the new pair on each turn.
+        if history is None:
+            history = ChatMessageHistory()
 
         logger.info('Input:\n%s', message)
-        bot_message = chat(message, history, self.indexes)
+        bot_message = await chat(message, history, self.agent_executor)
         logger.info('Output:\n%s', bot_message)
+        history.add_user_message(message)
+        history.add_ai_message(bot_message)
         chat_history.append((message, bot_message))
-        return '', chat_history
+        return '', chat_history, history
 
     def main(self):
         title = self.config.get('title', 'RAG Assistant')
         with gr.Blocks(title=title) as demo:
             chatbot = gr.Chatbot()
+            history = gr.State()
             msg = gr.Textbox()
             clear = gr.Button('Clear')
 
-            msg.submit(self._respond, [msg, chatbot], [msg, chatbot])
-            clear.click(lambda: None, None, chatbot, queue=False)
+            msg.submit(self._respond, [msg, chatbot, history], [msg, chatbot, history])
+            clear.click(lambda: (None, None), None, [chatbot, history], queue=False)
 
         app_env = os.environ.get('APP_ENV', 'production')
 
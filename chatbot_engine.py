@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 import os
 import re
-from typing import List
+import hashlib
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import List, Optional
 
-from langchain.agents import AgentType, initialize_agent
+from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain.agents.agent_toolkits import VectorStoreInfo, VectorStoreToolkit
 from langchain_community.document_loaders.base import BaseLoader
 from langchain_community.document_loaders import (
@@ -11,11 +17,15 @@ from langchain_community.document_loaders import (
     GitLoader,
     PyPDFLoader
 )
-from langchain_community.vectorstores import Chroma
-from langchain.indexes import VectorstoreIndexCreator
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 from langchain.indexes.vectorstore import VectorStoreIndexWrapper
-from langchain.memory import ChatMessageHistory, ConversationBufferMemory
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.memory import ChatMessageHistory
 from langchain.tools import BaseTool
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+import faiss
 
 from llm import (
     create_llm,
@@ -25,6 +35,41 @@ from embeddings import create_embeddings
 from message import MessageExpander
 
 
+logger = logging.getLogger(__name__)
+
+# Indexes with at least this many chunks use an HNSW graph instead of a flat scan
+HNSW_MIN_DOCUMENTS = 10000
+# Maximum number of embedding requests in flight while building an index
+EMBED_CONCURRENCY = 20
+
+# Semaphore bounding the tool calls of the agent run in progress
+_tool_semaphore: ContextVar[Optional[asyncio.Semaphore]] = ContextVar(
+    '_tool_semaphore', default=None
+)
+
+class ParallelAgentExecutor(AgentExecutor):
+    """AgentExecutor that runs the tool calls of one step concurrently.
+
+    The base class already gathers the tool calls of a step on the async
+    path; this subclass bounds how many of them run at the same time.
+    """
+    max_concurrency: int = 5
+
+    async def _acall(self, inputs, run_manager=None):
+        token = _tool_semaphore.set(asyncio.Semaphore(self.max_concurrency))
+        try:
+            return await super()._acall(inputs, run_manager=run_manager)
+        finally:
+            _tool_semaphore.reset(token)
+
+    async def _aperform_agent_action(
+        self, name_to_tool_map, color_mapping, agent_action, run_manager=None
+    ):
+        async with _tool_semaphore.get() or nullcontext():
+            return await super()._aperform_agent_action(
+                name_to_tool_map, color_mapping, agent_action, run_manager
+            )
+
 class IndexHolder:
     def __init__(self, index: VectorStoreIndexWrapper, config: dict):
         self._index = index
@@ -43,21 +88,73 @@ class IndexHolder:
     def tool_description(self):
         return self._tool_description
 
+def _deduplicate(docs: List[Document]) -> List[Document]:
+    seen = set()
+    unique_docs = []
+    for doc in docs:
+        digest = hashlib.blake2b(doc.page_content.encode(), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique_docs.append(doc)
+    if len(unique_docs) < len(docs):
+        logger.info('Skipped %d duplicate chunks', len(docs) - len(unique_docs))
+    return unique_docs
+
+def _create_embeddings():
+    return create_embeddings(max_retries=5, max_concurrency=EMBED_CONCURRENCY)
+
+async def _aembed_and_close(embedding, texts: List[str]) -> List[List[float]]:
+    try:
+        return await embedding.aembed_documents(texts)
+    finally:
+        # Close the async client's connections while the loop they belong to is running
+        await embedding.async_client._client.close()
+
+def _build_vectorstore(docs: List[Document], embedding) -> FAISS:
+    docs = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0).split_documents(docs)
+    # Identical chunks (license headers, vendored or generated files) are only embedded once
+    docs = _deduplicate(docs)
+    if not docs:
+        raise ValueError('No documents to index')
+    texts = [doc.page_content for doc in docs]
+    # The build runs on a throwaway event loop, so it uses its own embeddings
+    # instance. The one passed in is kept by the store for queries, which run
+    # on the app's loop and must not reuse connections bound to this one.
+    vectors = asyncio.run(_aembed_and_close(_create_embeddings(), texts))
+
+    dimension = len(vectors[0])
+    if len(vectors) >= HNSW_MIN_DOCUMENTS:
+        index = faiss.IndexHNSWFlat(dimension, 32)
+    else:
+        index = faiss.IndexFlatL2(dimension)
+    vectorstore = FAISS(embedding, index, InMemoryDocstore(), {})
+    vectorstore.add_embeddings(zip(texts, vectors), metadatas=[doc.metadata for doc in docs])
+    return vectorstore
+
+def _load_documents(loaders: List[BaseLoader]) -> List[Document]:
+    # Loaders are I/O-bound, so run them concurrently. GitLoader clones into
+    # and checks out a local directory, so it stays serial on this thread.
+    docs = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            None if isinstance(loader, GitLoader) else executor.submit(loader.load)
+            for loader in loaders
+        ]
+        for loader, future in zip(loaders, futures):
+            docs.extend(loader.load() if future is None else future.result())
+    return docs
+
 def _create_index(loaders: List[BaseLoader], persist_dir: str) -> VectorStoreIndexWrapper:
-    embedding = create_embeddings(max_retries=5, chunk_size=16)
-    if os.path.exists(persist_dir):
+    embedding = _create_embeddings()
+    if os.path.exists(os.path.join(persist_dir, 'index.faiss')):
         print(f'Import persistent data from {persist_dir}')
-        vectorstore = Chroma(
-            embedding_function=embedding,
-            persist_directory=persist_dir
-        )
-        return VectorStoreIndexWrapper(vectorstore=vectorstore)
+        # The index was written by this app, so its pickle is trusted
+        vectorstore = FAISS.load_local(persist_dir, embedding, allow_dangerous_deserialization=True)
     else:
-        return VectorstoreIndexCreator(
-            vectorstore_cls=Chroma,
-            vectorstore_kwargs={"persist_directory": persist_dir},
-            embedding=embedding
-        ).from_loaders(loaders)
+        docs = _load_documents(loaders)
+        vectorstore = _build_vectorstore(docs, embedding)
+        vectorstore.save_local(persist_dir)
+    return VectorStoreIndexWrapper(vectorstore=vectorstore)
 
 def _get_loader(loader_type: str, loader_kwargs: dict) -> BaseLoader:
     LOADER_CLASSES = {
@@ -73,9 +170,11 @@ def _get_loader(loader_type: str, loader_kwargs: dict) -> BaseLoader:
         if key.endswith('path'):
             loader_kwargs[key] = os.path.abspath(value)
         if key == 'file_filter':
+            pattern = re.compile(value)
             def filter(f):
-                m = re.fullmatch(value, f)
-                print(f) if m is not None else print(f, '...Skip')
+                m = pattern.fullmatch(f)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('%s%s', f, '' if m is not None else ' ...Skip')
                 return m is not None
             loader_kwargs[key] = filter
 
@@ -111,26 +210,47 @@ def _create_tools(indexes: List[IndexHolder], llm) -> List[BaseTool]:
 
     return tools
 
-def chat(
-    message: str, history: ChatMessageHistory, indexes: List[IndexHolder]
-) -> str:
-    llm = create_llm()
+def _create_prompt() -> ChatPromptTemplate:
+    return ChatPromptTemplate.from_messages([
+        ('system', 'You are a helpful assistant.'),
+        MessagesPlaceholder(variable_name='chat_history', optional=True),
+        MessagesPlaceholder(variable_name='input'),
+        MessagesPlaceholder(variable_name='agent_scratchpad'),
+    ])
+
+# Built once and reused across chat turns, so that the LLM client, tools
+# and prompt are not recreated for every message
+def create_agent_executor(indexes: List[IndexHolder], llm=None) -> AgentExecutor:
+    if llm is None:
+        llm = create_llm()
 
     tools = _create_tools(indexes, llm)
 
-    memory = ConversationBufferMemory(
-        chat_memory=history, memory_key="chat_history", return_messages=True
+    # The tools agent may request several tool calls in one step,
+    # which the executor runs concurrently on the async path
+    agent = create_openai_tools_agent(llm, tools, _create_prompt())
+    # A limit below 1 would block every tool call forever, or fail each turn
+    max_concurrency = int(os.environ.get('TOOL_CONCURRENCY_LIMIT', 5))
+    if max_concurrency < 1:
+        raise ValueError(f'Invalid TOOL_CONCURRENCY_LIMIT: {max_concurrency}')
+    return ParallelAgentExecutor(
+        agent=agent,
+        tools=tools,
+        handle_parsing_errors=True,
+        max_concurrency=max_concurrency
     )
 
-    agent_chain = initialize_agent(
-        tools, llm, agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
-        memory=memory,
-        handle_parsing_errors=True
-    )
-    # Expand message commands
-    messages = [MessageExpander().expand_message(message)]
+async def chat(
+    message: str, history: ChatMessageHistory, agent_executor: AgentExecutor
+) -> str:
+    # Expand message commands. This blocks on network, file and PDF work,
+    # so it runs in a worker thread to keep other sessions responsive.
+    messages = [await asyncio.to_thread(MessageExpander().expand_message, message)]
 
-    response = agent_chain.invoke({'input': messages}, config={'callbacks': extend_llm_callbacks()})
+    response = await agent_executor.ainvoke(
+        {'input': messages, 'chat_history': history.messages},
+        config={'callbacks': extend_llm_callbacks()}
+    )
     return response['output']
 
 def main():
@@ -151,7 +271,8 @@ def main():
     with open(args.config, 'r') as f:
         config = safe_load(f) 
     indexes = create_index_list(config)
-    response = chat(prompt, ChatMessageHistory(), indexes)
+    agent_executor = create_agent_executor(indexes)
+    response = asyncio.run(chat(prompt, ChatMessageHistory(), agent_executor))
     print(response)
 
 if __name__ == '__main__':
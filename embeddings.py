@@ -1,19 +1,175 @@
 import os
+import time
+import asyncio
+import threading
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple
 
+import tiktoken
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_openai import AzureOpenAIEmbeddings
 
 
-def create_embeddings(model_name=None, **kwargs):
+DEFAULT_EMBED_BATCH_SIZE = 256
+# Azure OpenAI accepts at most 16 inputs per embedding request
+AZURE_EMBED_BATCH_SIZE_LIMIT = 16
+# OpenAI rejects embedding requests whose inputs sum to more tokens than this
+DEFAULT_EMBED_BATCH_TOKENS = 300000
+
+
+class RateLimiter:
+    """Token bucket limiter that keeps requests and tokens under per-minute budgets.
+
+    Each acquisition reserves capacity up front and returns how long the caller
+    must wait, so concurrent callers queue up behind each other instead of
+    bursting into 429 responses.
+    """
+
+    def __init__(self, max_requests_per_minute: Optional[int] = None,
+                 max_tokens_per_minute: Optional[int] = None):
+        self._limits = (max_requests_per_minute, max_tokens_per_minute)
+        self._available = list(self._limits)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional['RateLimiter']:
+        rpm = os.environ.get('OPENAI_MAX_REQUESTS_PER_MINUTE')
+        tpm = os.environ.get('OPENAI_MAX_TOKENS_PER_MINUTE')
+        if not rpm and not tpm:
+            return None
+        return cls(int(rpm) if rpm else None, int(tpm) if tpm else None)
+
+    def _reserve(self, num_tokens: int) -> float:
+        """Debit one request and num_tokens tokens, returning the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._updated = now
+            wait = 0.0
+            for i, (limit, amount) in enumerate(zip(self._limits, (1, num_tokens))):
+                if limit is None:
+                    continue
+                rate = limit / 60.0
+                available = min(limit, self._available[i] + elapsed * rate)
+                # A single request larger than the budget can only wait for a full bucket
+                available -= min(amount, limit)
+                self._available[i] = available
+                if available < 0:
+                    wait = max(wait, -available / rate)
+            return wait
+
+    def acquire(self, num_tokens: int = 0):
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, num_tokens: int = 0):
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+@lru_cache(maxsize=None)
+def _shared_rate_limiter() -> Optional[RateLimiter]:
+    # The budgets are per account, so every embeddings instance in the process
+    # must draw from the same buckets
+    return RateLimiter.from_env()
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: str):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+class _RateLimitedEmbeddingsMixin:
+    """Pack texts into requests by count and token budget, throttling each
+    request through `rate_limiter` when it is set.
+
+    Retries on 429 are left to the OpenAI client, which honors Retry-After.
+
+    Note that every text is tokenized twice: once here to size the batches,
+    and again by the base class, which splits texts longer than the model's
+    context before sending them.
+    """
+
+    def _pack_batches(self, texts: List[str], chunk_size: Optional[int] = 0) -> List[Tuple[List[str], int]]:
+        """Return (texts, token count) batches that fit both limits per request."""
+        max_texts = chunk_size or self.chunk_size
+        encoding = _get_encoding(self.model)
+        batches = []
+        batch, batch_tokens = [], 0
+        for text in texts:
+            num_tokens = len(encoding.encode(text, disallowed_special=()))
+            if batch and (len(batch) >= max_texts or batch_tokens + num_tokens > self.max_batch_tokens):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += num_tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def embed_documents(self, texts: List[str], chunk_size: Optional[int] = 0) -> List[List[float]]:
+        embeddings = []
+        for batch, num_tokens in self._pack_batches(texts, chunk_size):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(num_tokens)
+            embeddings.extend(super().embed_documents(batch, chunk_size))
+        return embeddings
+
+    async def aembed_documents(self, texts: List[str], chunk_size: Optional[int] = 0) -> List[List[float]]:
+        """Embed the batches concurrently, at most `max_concurrency` at a time."""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        embed_batch = super().aembed_documents
+
+        async def embed(batch, num_tokens):
+            async with semaphore:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.aacquire(num_tokens)
+                return await embed_batch(batch, chunk_size)
+
+        results = await asyncio.gather(
+            *(embed(batch, num_tokens) for batch, num_tokens in self._pack_batches(texts, chunk_size))
+        )
+        return [embedding for result in results for embedding in result]
+
+
+class RateLimitedOpenAIEmbeddings(_RateLimitedEmbeddingsMixin, OpenAIEmbeddings):
+    rate_limiter: Optional[Any] = None
+    max_batch_tokens: int = DEFAULT_EMBED_BATCH_TOKENS
+    max_concurrency: int = 1
+
+
+class RateLimitedAzureOpenAIEmbeddings(_RateLimitedEmbeddingsMixin, AzureOpenAIEmbeddings):
+    rate_limiter: Optional[Any] = None
+    max_batch_tokens: int = DEFAULT_EMBED_BATCH_TOKENS
+    max_concurrency: int = 1
+
+
+def create_embeddings(model_name=None, chunk_size=None, **kwargs):
+    if chunk_size is None:
+        chunk_size = int(os.environ.get('OPENAI_EMBED_BATCH_SIZE', DEFAULT_EMBED_BATCH_SIZE))
+    if 'request_timeout' not in kwargs and os.environ.get('OPENAI_EMBED_REQUEST_TIMEOUT'):
+        kwargs['request_timeout'] = float(os.environ['OPENAI_EMBED_REQUEST_TIMEOUT'])
+    if 'max_batch_tokens' not in kwargs and os.environ.get('OPENAI_EMBED_MAX_BATCH_TOKENS'):
+        kwargs['max_batch_tokens'] = int(os.environ['OPENAI_EMBED_MAX_BATCH_TOKENS'])
+    kwargs.setdefault('show_progress_bar', False)
+    kwargs.setdefault('rate_limiter', _shared_rate_limiter())
+
     openai_api_type = os.environ.get('OPENAI_API_TYPE', None)
     if openai_api_type == 'azure':
         if not model_name:
             model_name = os.environ.get('AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME', None)
-        embeddings = AzureOpenAIEmbeddings(azure_deployment=model_name, **kwargs)
+        chunk_size = min(chunk_size, AZURE_EMBED_BATCH_SIZE_LIMIT)
+        embeddings = RateLimitedAzureOpenAIEmbeddings(azure_deployment=model_name, chunk_size=chunk_size, **kwargs)
     else:
         if not model_name:
             model_name = os.environ.get('OPENAI_EMBEDDING_NAME', 'text-embedding-3-small')
-        embeddings = OpenAIEmbeddings(model=model_name, **kwargs)
+        embeddings = RateLimitedOpenAIEmbeddings(model=model_name, chunk_size=chunk_size, **kwargs)
     return embeddings
 
 if __name__ == '__main__':
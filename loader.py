@@ -1,80 +1,248 @@
 #!/usr/bin/env python
 import os
 import re
-from langchain_community.document_loaders import ConfluenceLoader
-from langchain_community.document_loaders import WebBaseLoader
+import json
+import sqlite3
+import itertools
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
 from langchain_core.documents import Document
 
 
 class LoaderOptionParser():
+    # Accepted ranges of the integer options; a high dpi renders huge pixmaps
+    INT_OPTION_RANGES = {
+        'dpi': (36, 300),
+        'quality': (1, 95),
+    }
+
     def __init__(self):
         self.options = {}
 
     def parse(self, options_str):
         for option in options_str.split(';'):
-            key, value = option.split('=', 1)
+            key, _, value = option.partition('=')
             key, value = key.strip(), value.strip()
             if key == 'pages':
                 value = self._parse_pages(value)
+            elif key in self.INT_OPTION_RANGES:
+                value = self._parse_int(key, value)
             self.options[key] = value
         return self.options
 
+    @classmethod
+    def _parse_int(cls, key: str, value: str) -> int:
+        low, high = cls.INT_OPTION_RANGES[key]
+        try:
+            number = int(value)
+        except ValueError:
+            raise ValueError(f'Invalid {key}: {value}') from None
+        if not low <= number <= high:
+            raise ValueError(f'Invalid {key}: {value} (must be between {low} and {high})')
+        return number
+
     @staticmethod
     def _parse_pages(pages: str) -> list:
         """Parse the pages option and return a list of zero-indexed page numbers."""
-        page_numbers = set()
+        ranges = []
         for part in pages.split(','):
-            if '-' in part:
-                start, end = map(int, part.split('-'))
-                page_numbers.update(range(start, end + 1))
-            else:
-                page_numbers.add(int(part))
-        # Convert to zero-indexed page numbers
-        page_numbers = [n - 1 for n in page_numbers]
-        if any(n < 0 for n in page_numbers):
-            raise ValueError(f'Invalid page numbers: {pages}')
-        return list(sorted(page_numbers))
+            start, sep, end = part.partition('-')
+            start = int(start)
+            end = int(end) if sep else start
+            # Validate before materializing any page numbers
+            if start < 1:
+                raise ValueError(f'Invalid page numbers: {pages}')
+            # Convert to zero-indexed page numbers
+            ranges.append(range(start - 1, end))
+        return sorted(set(itertools.chain.from_iterable(ranges)))
+
+class PageCache:
+    """Loaded pages kept in memory and in an SQLite file, together with the
+    validators (ETag, Last-Modified or page version) needed to check that a
+    cached page is still current before serving it."""
+
+    # Number of pages also kept in memory, least recently used first out
+    MEMORY_SIZE = 64
+
+    def __init__(self, path=None):
+        # Without a path, the file's location is read from the environment on
+        # first use, after the app has loaded its .env file
+        self.path = path
+        self._memory = OrderedDict()
+        self._conn = None
+        # Pages are loaded from worker threads, which share the connection
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Opened on first use, so that importing the module touches no files
+        if self._conn is None:
+            if self.path is None:
+                cache_dir = os.environ.get('LLM_ASSISTANT_CACHE_DIR',
+                                           os.path.expanduser('~/.cache/llm-assistant'))
+                self.path = os.path.join(cache_dir, 'pages.sqlite')
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS pages '
+                               '(key TEXT PRIMARY KEY, validators TEXT, page_content TEXT, metadata TEXT)')
+        return self._conn
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.MEMORY_SIZE:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached (validators, Document) for key, or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            row = self._connection().execute(
+                'SELECT validators, page_content, metadata FROM pages WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            validators, page_content, metadata = row
+            entry = (json.loads(validators), Document(page_content=page_content, metadata=json.loads(metadata)))
+            self._remember(key, entry)
+            return entry
+
+    def put(self, key, validators, doc):
+        with self._lock:
+            self._remember(key, (validators, doc))
+            conn = self._connection()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(validators), doc.page_content,
+                              json.dumps(doc.metadata, default=str)))
+
+_page_cache = PageCache()
+
+# Mounted on every loader's session, so that all of them draw on the same
+# per-host keep-alive connection pools
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+
+def _new_session():
+    session = requests.Session()
+    session.mount('https://', _HTTP_ADAPTER)
+    session.mount('http://', _HTTP_ADAPTER)
+    return session
+
+def _response_validators(response):
+    return {name: response.headers[name] for name in ('ETag', 'Last-Modified') if name in response.headers}
+
+def _conditional_headers(validators):
+    headers = {}
+    if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    return headers
 
 # dependencies: atlassian-python-api, lxml
 class ConfluencePageLoader:
+    # Page URLs look like {base_url}/spaces/{space}/pages/{id}/{title}
+    _PAGE_RE = re.compile(r'/pages/(\d+)(?:/|$)')
+
     def __init__(self):
         self.base_url = os.environ.get('CONFLUENCE_WIKI_URL')
         self.username = os.environ.get('ATTLASIAN_USER_EMAIL')
         self.api_key = os.environ.get('ATTLASIAN_API_TOKEN')
+        # Shared by every ConfluenceLoader so that connections are reused
+        self._session = _new_session()
+        self._session.auth = (self.username, self.api_key)
+        self._base_url_prefix = None
+        if self.base_url:
+            self._base_url_prefix = self.base_url.rstrip('/') + '/'
+            self._base_netloc = urlsplit(self.base_url).netloc
 
     def is_target_path(self, url):
-        return url.startswith(self.base_url)
+        return self._base_url_prefix is not None and url.startswith(self._base_url_prefix)
 
     def load(self, path, options={}):
-        match = re.match(rf'{self.base_url}/(?:\S+/)+pages/(\d+)/.*', path)
+        from langchain_community.document_loaders import ConfluenceLoader
+
+        parts = urlsplit(path)
+        match = parts.netloc == self._base_netloc and self._PAGE_RE.search(parts.path)
         if not match:
             raise ValueError(f'Invalid Confluence URL: {path}')
         page_id = match.group(1)
+        # The page version identifies its content, so a cached copy of the
+        # same version is served without fetching and converting the body
+        cache_key = f'{self.base_url}/pages/{page_id}'
+        version = self._get_page_version(page_id)
+        cached = _page_cache.get(cache_key)
+        if cached and version is not None and cached[0].get('version') == version:
+            return cached[1]
         loader = ConfluenceLoader(
             url=self.base_url,
-            username=self.username,
-            api_key=self.api_key,
+            session=self._session,
+            # ConfluenceLoader only applies its cloud=True default without a session
+            confluence_kwargs={'cloud': True},
             page_ids=[page_id],
             keep_markdown_format=True
         )
-        doc = loader.load()[0]
+        # Only the first document is used, so stop after fetching it
+        doc = next(loader.lazy_load(), None)
+        if doc is None:
+            raise ValueError(f'Confluence page not found: {path}')
+        if version is not None:
+            _page_cache.put(cache_key, {'version': version}, doc)
         return doc
 
+    def _get_page_version(self, page_id):
+        try:
+            response = self._session.get(f'{self.base_url}/rest/api/content/{page_id}',
+                                         params={'expand': 'version'}, timeout=15)
+            response.raise_for_status()
+            return response.json()['version']['number']
+        except (requests.RequestException, ValueError, KeyError):
+            return None
+
 # dependencies: langchain_community, beautifulsoup4
 class WebPageLoader:
     def __init__(self):
-        pass
+        self._session = None
+
+    def _get_session(self):
+        # Shared by every WebBaseLoader so that connections are reused
+        if self._session is None:
+            from langchain_community.document_loaders.web_base import default_header_template
+            self._session = _new_session()
+            self._session.headers.update(default_header_template)
+        return self._session
 
     def is_target_path(self, path):
-        from urllib.parse import urlparse
-        parsed_url = urlparse(path)
-        return parsed_url.scheme in ['http', 'https']
+        return path.startswith(('http://', 'https://'))
 
     def load(self, path, options={}):
-        loader = WebBaseLoader(path)
-        doc = loader.load()[0]
+        from langchain_community.document_loaders import WebBaseLoader
+
+        # A cached page is requested conditionally, and served as is on 304.
+        # The hook captures the final response that WebBaseLoader receives.
+        cached = _page_cache.get(path)
+        responses = []
+        requests_kwargs = {
+            'timeout': 15,
+            'hooks': {'response': lambda response, *args, **kwargs: responses.append(response)},
+        }
+        if cached:
+            requests_kwargs['headers'] = _conditional_headers(cached[0])
+
+        loader = WebBaseLoader(path, requests_kwargs=requests_kwargs, session=self._get_session())
+        doc = next(loader.lazy_load())
+        response = responses[-1] if responses else None
+        if cached and response is not None and response.status_code == 304:
+            return cached[1]
         if not doc.metadata.get('title'):
             doc.metadata['title'] = 'Untitled'
+        # Pages without validators cannot be revalidated, so they are not cached
+        validators = _response_validators(response) if response is not None and response.ok else {}
+        if validators:
+            _page_cache.put(path, validators, doc)
         return doc
 
 class PDFTextLoader:
@@ -1,30 +1,150 @@
 import os
 import re
-import base64
-from io import BytesIO
+import mmap
+import threading
+from binascii import b2a_base64
+from functools import lru_cache
+from collections import OrderedDict
 
 from langchain_core.messages import HumanMessage
-import pdf2image
 
 import loader
 
 
+# Read size for streamed base64 encoding. A multiple of 3, so that every
+# chunk encodes without padding and the outputs can simply be concatenated.
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+# Resolution and JPEG quality of rasterized PDF pages sent to the LLM
+PDF_RENDER_DPI = 100
+PDF_JPEG_QUALITY = 70
+# Number of PDF pages rendered between flushes of MuPDF's resource store
+PDF_PAGE_WINDOW = 10
+# Number of rendered PDF pages kept across messages
+PDF_PAGE_CACHE_SIZE = 256
+
+# A negated class scans to the closing brace without the per-character
+# backtracking of a lazy '.*?'; excluding newlines keeps the same matches
+_IMPORTER_RE = re.compile(r'\{([^}\n]*)\}')
+
+
+def _encode_file(path: str, prefix: bytes = b'') -> str:
+    # Read into a reused buffer and write into an output buffer sized for
+    # the whole file, so neither the raw file nor a growing copy is held
+    size = os.path.getsize(path)
+    encoded = bytearray(len(prefix) + (size + 2) // 3 * 4)
+    encoded[:len(prefix)] = prefix
+    chunk = bytearray(ENCODE_CHUNK_SIZE)
+    view = memoryview(chunk)
+    offset = len(prefix)
+    with open(path, 'rb') as f:
+        while n := f.readinto(chunk):
+            block = b2a_base64(view[:n], newline=False)
+            encoded[offset:offset + len(block)] = block
+            offset += len(block)
+    # The file may have changed size since it was measured
+    del encoded[offset:]
+    return encoded.decode('ascii')
+
+# The cached helpers below take the file's mtime and size as part of the key,
+# so that a file edited between turns is read again.
+
+@lru_cache(maxsize=64)
+def _image_data_url(path: str, mtime_ns: int, size: int, image_type: str) -> str:
+    # The encoder writes after the prefix, so the URL is not copied again
+    return _encode_file(path, f'data:image/{image_type};base64,'.encode('ascii'))
+
+@lru_cache(maxsize=64)
+def _read_text_file(path: str, mtime_ns: int, size: int) -> str:
+    if size == 0:
+        return ''
+    # Decode straight from the mapped pages instead of through a read buffer
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # utf-8-sig also drops a leading BOM, which text mode reading kept
+        text = str(mm, 'utf-8-sig', 'replace')
+    # Translate newlines as text mode reading did
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+def _iter_pdf_pages(pdf_path: str, page_numbers: tuple,
+                    dpi: int = PDF_RENDER_DPI, quality: int = PDF_JPEG_QUALITY):
+    """Yield the given zero-indexed pages (all pages if empty) as base64 JPEGs,
+    rendering one page at a time."""
+    import pymupdf
+
+    with pymupdf.open(pdf_path) as doc:
+        # Pages past the end are skipped, as pdf2image clamped its page range
+        page_numbers = [i for i in page_numbers or range(doc.page_count) if i < doc.page_count]
+        for start in range(0, len(page_numbers), PDF_PAGE_WINDOW):
+            for i in page_numbers[start:start + PDF_PAGE_WINDOW]:
+                pix = doc[i].get_pixmap(dpi=dpi)
+                jpeg = pix.tobytes('jpeg', jpg_quality=quality)
+                # Free the raw pixels before the base64 output is allocated
+                del pix
+                yield b2a_base64(jpeg, newline=False).decode('ascii')
+                del jpeg
+            # Release the fonts and images MuPDF cached while rendering the window
+            pymupdf.TOOLS.store_shrink(100)
+
+# Rendered pages as data URLs by (path, mtime_ns, size, page, dpi, quality), least
+# recently used first
+_pdf_page_cache = OrderedDict()
+# Messages are expanded in worker threads, which share the cache
+_pdf_page_cache_lock = threading.Lock()
+# MuPDF is not thread-safe, so those threads render one at a time
+_pdf_render_lock = threading.Lock()
+
+def _rasterize_pdf(pdf_path: str, mtime_ns: int, size: int, page_numbers: tuple,
+                   dpi: int = PDF_RENDER_DPI, quality: int = PDF_JPEG_QUALITY) -> list:
+    """Return the given zero-indexed pages (all pages if empty) as data URLs,
+    rendering only the pages that are not already cached."""
+    import pymupdf
+
+    with _pdf_render_lock, pymupdf.open(pdf_path) as doc:
+        page_count = doc.page_count
+    page_numbers = [i for i in page_numbers or range(page_count) if i < page_count]
+    keys = [(pdf_path, mtime_ns, size, i, dpi, quality) for i in page_numbers]
+    with _pdf_page_cache_lock:
+        cached = {key: _pdf_page_cache[key] for key in keys if key in _pdf_page_cache}
+    # Render outside the lock, so that other threads can read the cache meanwhile
+    missing = tuple(i for i, key in zip(page_numbers, keys) if key not in cached)
+    if missing:
+        with _pdf_render_lock:
+            rendered = list(_iter_pdf_pages(pdf_path, missing, dpi, quality))
+        for i, img_str in zip(missing, rendered):
+            cached[(pdf_path, mtime_ns, size, i, dpi, quality)] = f'data:image/jpg;base64,{img_str}'
+
+    with _pdf_page_cache_lock:
+        for key in keys:
+            _pdf_page_cache[key] = cached[key]
+            _pdf_page_cache.move_to_end(key)
+        while len(_pdf_page_cache) > PDF_PAGE_CACHE_SIZE:
+            _pdf_page_cache.popitem(last=False)
+    return [cached[key] for key in keys]
+
 def encode_image(image_path: str) -> str:
-    with open(image_path, 'rb') as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    return _encode_file(image_path)
 
 class MessageExpander:
     IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif'}
-    IMPORTER_PATTERN = r'\{(.*?)\}'
+
+    # Loaders are shared by every expander and created on first use
+    _loaders = None
 
     def __init__(self):
         self.content_list = []
-        # Note that ConfluencePageLoader must precede WebPageLoader,
-        # otherwise the WebPageLoader will always be used for https URLs
-        self.loaders = [
-            loader.ConfluencePageLoader(),
-            loader.WebPageLoader()
-        ]
+
+    @classmethod
+    def _get_loaders(cls):
+        if cls._loaders is None:
+            # Note that ConfluencePageLoader must precede WebPageLoader,
+            # otherwise the WebPageLoader will always be used for https URLs
+            cls._loaders = (
+                loader.ConfluencePageLoader(),
+                loader.WebPageLoader()
+            )
+        return cls._loaders
 
     def expand_message(self, message: str) -> HumanMessage:
         """Expand the message by expanding file imports.
@@ -35,14 +155,14 @@ class MessageExpander:
         Returns:
             A HumanMessage object with the file imports expanded.
         """
-        segments = self._separate_message(message)
-        for segment in segments:
-            if match := re.match(self.IMPORTER_PATTERN, segment):
-                path, options = self._parse_placeholder(match.group(1))
+        self.content_list = []
+        for segment, placeholder in self._separate_message(message):
+            if placeholder:
+                path, options = placeholder
                 title = options.get('title')
 
                 handled_by_loader = False
-                for loader in self.loaders:
+                for loader in self._get_loaders():
                     if loader.is_target_path(path):
                         doc = loader.load(path)
                         if not title:
@@ -68,48 +188,52 @@ class MessageExpander:
                 continue
             self._append_text_content(segment)
 
+        # Text entries collect their segments in a list; join each one once
+        for content in self.content_list:
+            if content['type'] == 'text':
+                content['text'] = '\n'.join(content.pop('parts'))
+
         if len(self.content_list) == 1 and self.content_list[0].get('type') == 'text':
             return HumanMessage(content=self.content_list[0]['text'])
         return HumanMessage(content=self.content_list)
 
     @classmethod
     def _separate_message(cls, message: str):
-        segments = []
+        """Yield (segment, placeholder) pairs, where placeholder is the parsed
+        (path, options) of an import and None for plain text."""
         start = 0
 
-        for match in re.finditer(cls.IMPORTER_PATTERN, message):
-            # Add the text before the matched pattern as a segment
+        for match in _IMPORTER_RE.finditer(message):
+            # Yield the text before the matched pattern as a segment
             if match.start() > start:
-                segments.append(message[start:match.start()])
+                yield message[start:match.start()], None
 
-            # Add the matched text as a segment
-            segments.append(match.group(0))
+            # Yield the matched text as a segment
+            yield match.group(0), cls._parse_placeholder(match.group(1))
 
             start = match.end()
 
-        # Add the remaining text after the last matched pattern as a segment
+        # Yield the remaining text after the last matched pattern as a segment
         if start < len(message):
-            segments.append(message[start:])
-
-        return segments
+            yield message[start:], None
 
     @staticmethod
     def _parse_placeholder(placeholder_str: str) -> dict:
-        if '|' not in placeholder_str:
-            return placeholder_str, {}
-        path, options_str = placeholder_str.split('|')
+        path, sep, options_str = placeholder_str.partition('|')
+        if not sep:
+            return path.strip(), {}
         options = loader.LoaderOptionParser().parse(options_str)
         return path.strip(), options
 
     def _append_text_content(self, content):
         if self.content_list and self.content_list[-1].get('type') == 'text':
-            self.content_list[-1]['text'] += '\n' + content
+            self.content_list[-1]['parts'].append(content)
         else:
-            self.content_list.append({'type': 'text', 'text': content})
+            self.content_list.append({'type': 'text', 'parts': [content]})
 
     def _append_file_content(self, title, path):
-        with open(path, 'r') as f:
-            file_content = f.read()
+        stat = os.stat(path)
+        file_content = _read_text_file(path, stat.st_mtime_ns, stat.st_size)
         if title:
             file_content = f'### {title} ###\n```\n{file_content}\n```\n'
         self._append_text_content(file_content)
@@ -118,12 +242,12 @@ class MessageExpander:
         if title:
             title_text = f'### {title} ###\n'
             self._append_text_content(title_text)
-        base64_image = encode_image(path)
         image_type = os.path.splitext(path)[1].lstrip('.')
+        stat = os.stat(path)
         self.content_list.append({
             'type': 'image_url',
             'image_url': {
-                'url': f'data:image/{image_type};base64,{base64_image}'
+                'url': _image_data_url(path, stat.st_mtime_ns, stat.st_size, image_type)
             }
         })
 
@@ -132,66 +256,17 @@ class MessageExpander:
             title_text = f'### {title} ###\n'
             self._append_text_content(title_text)
         page_numbers = options.get('pages')
+        # Lower values shrink the images, and the tokens they cost, quadratically.
+        # LoaderOptionParser has already validated and converted both.
+        dpi = options.get('dpi', PDF_RENDER_DPI)
+        quality = options.get('quality', PDF_JPEG_QUALITY)
 
-        if page_numbers:
-            for start, end in self._compute_page_ranges(page_numbers):
-                for image in pdf2image.convert_from_path(pdf_path, first_page=start, last_page=end):
-                    self._process_page_image(image)
-        else:
-            for image in pdf2image.convert_from_path(pdf_path):
-                self._process_page_image(image)
-
-    def _compute_page_ranges(self, page_numbers):
-        ranges = []
-        page_numbers = sorted(set(page_numbers))
-        # Convert to page numbers starting from 1
-        page_numbers = [n + 1 for n in page_numbers]
-        start = page_numbers[0]
-        end = start
-
-        for page in page_numbers[1:]:
-            if page == end + 1:
-                end = page
-            else:
-                ranges.append((start, end))
-                start = page
-                end = start
-        ranges.append((start, end))
-
-        return ranges
-
-    def _process_page_image(self, image):
-        buffered = BytesIO()
-        image.save(buffered, format='jpeg')
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        self.content_list.append({
+        stat = os.stat(pdf_path)
+        urls = _rasterize_pdf(pdf_path, stat.st_mtime_ns, stat.st_size, tuple(page_numbers or ()), dpi, quality)
+        # Extending by a list of known length grows content_list once per document
+        self.content_list.extend([{
             'type': 'image_url',
             'image_url': {
-                'url': f'data:image/jpg;base64,{img_str}'
+                'url': url
             }
-        })
-
-# dependencies: atlassian-python-api, lxml
-class ConfluencePageLoader:
-    def __init__(self):
-        self.base_url = os.environ.get('CONFLUENCE_WIKI_URL')
-        self.username = os.environ.get('ATTLASIAN_USER_EMAIL')
-        self.api_key = os.environ.get('ATTLASIAN_API_TOKEN')
-
-    def is_target_path(self, url):
-        return url.startswith(self.base_url)
-
-    def load(self, path):
-        match = re.match(rf'{self.base_url}/(?:\S+/)+pages/(\d+)/.*', path)
-        if not match:
-            raise ValueError(f'Invalid Confluence URL: {path}')
-        page_id = match.group(1)
-        loader = ConfluenceLoader(
-            url=self.base_url,
-            username=self.username,
-            api_key=self.api_key,
-            page_ids=[page_id],
-            keep_markdown_format=True
-        )
-        doc = loader.load()[0]
-        return doc
+        } for url in urls])